@@ -6,7 +6,7 @@ setup(
     author="MathSquared",
     description="A source manager for research projects (not source code)",
     license="MIT",
-    packages=["sourcewrangler"],
+    packages=["sourcewrangler", "sourcewrangler.command", "sourcewrangler.retriever"],
     entry_points={
         "console_scripts": [
             "sw = sourcewrangler:main",
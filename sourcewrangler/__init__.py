@@ -1,5 +1,11 @@
 def main():
-    pass
+    # Commands and retrievers register themselves on import, so load them all before locking the registries. They're imported here rather than at the top, so that importing e.g. sourcewrangler.manifest doesn't pull in the command layer.
+    from sourcewrangler import command, retriever
+    import sourcewrangler.command.open
+    import sourcewrangler.command.values
+
+    command._freeze()
+    retriever._freeze()
 
 if __name__ == "__main__":
     main()
@@ -5,6 +5,8 @@ SourceWrangler can perform various operations. Each one is encapsulated as a com
 All commands are classes decorated with @register_command('name'), which will make the command run with `sw name`. They must define the static specify_args method, which takes an argparse that the command should fill with arguments. They must also define an instance method named run, which will receive a SourceFolder along with a Namespace generated by parsing the arguments using the generated argparse. Finally, they may define strings _description and _help, which provide a long-form description and terse help string for the command, respectively.
 """
 
+import types
+
 
 _registry = {}
 
@@ -41,8 +43,8 @@ class InvalidCommandError(Exception):
 
 
 def all_commands():
-    """Returns a generator yielding all registered commands, in arbitrary order."""
-    return (value for _, value in _registry.iteritems())
+    """Returns an iterator yielding all registered commands, in arbitrary order."""
+    return iter(_registry.values())
 
 
 def has_command(name):
@@ -51,7 +53,13 @@ def has_command(name):
 
 def get_command(name):
     """Gets the command with a given name, or raises InvalidCommandError if the command does not exist."""
-    if has_command(name):
+    try:
         return _registry[name]
-    else:
-        raise InvalidCommndError
+    except KeyError:
+        raise InvalidCommandError
+
+
+def _freeze():
+    """Makes the registry read-only. Call this once every command has been registered; registering a command afterwards raises TypeError."""
+    global _registry
+    _registry = types.MappingProxyType(dict(_registry))
@@ -1,4 +1,4 @@
-import command
+from sourcewrangler import command
 import webbrowser
 
 @command.register_command("open")
@@ -21,23 +21,23 @@ class OpenCommand(object):
                             const="web",
                             help="Open the file in your web browser.")
 
-        def run(self, sf, args):
-            # Sanity check
-            if args.key not in sf:
-                raise command.UserError("Source ID not found")
-
-            if args.medium == "local":
-                fname = sf[args.key]
-
-                # TODO write a better cross-platform openfile thingie; this is a dirty hack
-                webbrowser.open(fname)
-            elif args.medium == "web":
-                url = None
-                with sf.open_manifest() as mf:
-                    try:
-                        url = mf[args.key]["human"]
-                    except KeyError:
-                        raise command.UserError("No URL defined for this source")
-                webbrowser.open(url)
-            else:
-                assert False
+    def run(self, sf, args):
+        # Sanity check
+        if args.key not in sf:
+            raise command.UserError("Source ID not found")
+
+        if args.medium == "local":
+            fname = sf[args.key]
+
+            # TODO write a better cross-platform openfile thingie; this is a dirty hack
+            webbrowser.open(fname)
+        elif args.medium == "web":
+            url = None
+            with sf.open_manifest() as mf:
+                try:
+                    url = mf[args.key]["human"]
+                except KeyError:
+                    raise command.UserError("No URL defined for this source")
+            webbrowser.open(url)
+        else:
+            assert False
@@ -1,4 +1,4 @@
-import command
+from sourcewrangler import command
 
 @command.register_command("values")
 class ValuesCommand(object):
@@ -24,7 +24,7 @@ class ValuesCommand(object):
                             help="Print all unique titles.")
 
     def run(self, sf, args):
-        print "Found the following values for '%s':" % args.field
-        with mf as sf.open_manifest():
+        print("Found the following values for '%s':" % args.field)
+        with sf.open_manifest() as mf:
             for value in sorted(mf.values(args.field)):
-                print value
+                print(value)
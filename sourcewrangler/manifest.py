@@ -1,7 +1,36 @@
-import codecs
+import collections
+import contextlib
+import hashlib
 import json
+import marshal
+import mmap
 import os
 import re
+import sys
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+
+# Stands in for the value of a field in sources that lack it; see Manifest._column.
+_MISSING = object()
+
+# Identifies the format of the parsed manifests cached by ManifestFile; see ManifestFile._read_cache. Bump the version whenever the format changes.
+_CACHE_HEADER = ("sourcewrangler-manifest-cache", 1)
+
+# Fields that take the same few values across many sources. Their values are interned on load and when sources are added or replaced, so each distinct value is stored once.
+_INTERNED_FIELDS = ("author", "category", "media")
+
+
+def _intern_fields(source):
+    """Interns the string values of the fields in _INTERNED_FIELDS in the given source dict, in place."""
+    for field in _INTERNED_FIELDS:
+        value = source.get(field)
+        if isinstance(value, str):
+            source[field] = sys.intern(value)
+
 
 class Manifest(object):
     """Represents the manifest for a given source folder.
@@ -13,20 +42,60 @@ class Manifest(object):
         """Initializes a new Manifest object.
 
         Args:
-            fp: a readable file-like object storing the JSON file. It should be an array of objects. The Manifest does not preserve a reference to fp.
+            fp: a readable file-like object storing the JSON file. It should be an array of objects; if it isn't, this raises ValueError. The Manifest does not preserve a reference to fp.
         """
-        self._manifest = json.load(fp)
+        self._load(fp.read())
+
+    @classmethod
+    def from_bytes(cls, buf, encoding="utf_8"):
+        """Creates a new Manifest from the raw contents of a JSON file.
+
+        This decodes and parses the whole buffer in one pass, which is much faster than reading through a text-mode file-like object.
+
+        Args:
+            buf: a bytes-like object storing the encoded JSON file. It should be an array of objects; if it isn't, this raises ValueError. The Manifest does not preserve a reference to buf.
+            encoding: The character encoding of buf.
+        """
+        mf = cls.__new__(cls)
+        mf._load(str(buf, encoding))
+        return mf
+
+    @classmethod
+    def _from_sources(cls, sources):
+        mf = cls.__new__(cls)
+        mf._set_sources(sources)
+        return mf
+
+    def _load(self, text):
+        self._set_sources(json.loads(text))
+
+    def _set_sources(self, sources):
+        """Makes the given list of source dicts the contents of this Manifest. Raises ValueError if sources isn't a list of dicts."""
+        if not isinstance(sources, list) or not all(isinstance(source, dict) for source in sources):
+            raise ValueError
+
+        for source in sources:
+            _intern_fields(source)
+
+        self._manifest = sources
+        self._columns = {}
+        self._indexes = {}
+        self._dirty = False
 
     def revert(self, fp):
         """Overwrites this Manifest with the state of the given readable file-like object."""
-        self._manifest = json.load(fp)
+        self._load(fp.read())
 
     def commit(self, fp):
         """Writes the Manifest to the given writable file-like object."""
-        json.dump(self._manifest, fp)
+        fp.write(json.dumps(self._manifest))
+
+    def to_bytes(self, encoding="utf_8"):
+        """Returns the Manifest serialized as a JSON file in the given character encoding."""
+        return json.dumps(self._manifest).encode(encoding)
 
     def get(self, key):
-        """Returns the dict representing the source with a given integer ID."""
+        """Returns the dict representing the source with a given integer ID. Don't modify it in place; use replace instead, so that values and search stay accurate."""
         return self._manifest[key]
 
     def __getitem__(self, key):
@@ -38,34 +107,73 @@ class Manifest(object):
     def __len__(self):
         return len(self._manifest)
 
+    def _column(self, field):
+        """Returns a list of the values of the given field for each source, in ID order, with _MISSING for sources that lack the field. The list is built on first use and cached until the manifest is modified.
+
+        Queries on a single field scan this list instead of looking the field up in every source's dict.
+        """
+        column = self._columns.get(field)
+        if column is None:
+            column = [source.get(field, _MISSING) for source in self._manifest]
+            self._columns[field] = column
+        return column
+
+    def _ensure_index(self, field):
+        """Returns a dict mapping each value of the given field to the IDs of the sources with that value, in ascending order. The dict is built on first use and cached until the manifest is modified.
+
+        Raises TypeError if some value of the field is unhashable.
+        """
+        index = self._indexes.get(field)
+        if index is None:
+            index = collections.defaultdict(list)
+            for key, value in enumerate(self._column(field)):
+                if value is not _MISSING:
+                    index[value].append(key)
+            self._indexes[field] = index = dict(index)
+        return index
+
     def values(self, field):
         """Returns a set of the unique values of the given field among all sources in this manifest."""
-        found = set()
-        for source in self._manifest:
-            if field in source:
-                found.add(source[field])
+        index = self._indexes.get(field)
+        if index is not None:
+            return set(index)
+
+        # Building an index would mean recording the IDs for every value, which we don't need here.
+        found = set(self._column(field))
+        found.discard(_MISSING)
         return found
 
     def search(self, field, query, is_regex):
-        """Returns the IDs of all sources that match the given query in the given field."""
-        results = []
-        for key, source in enumerate(self._manifest):
-            if is_regex:
-                if field in source and re.search(query, source[field]):
-                    results.append(key)
-            else:
-                if field in source and source[field] == query:
-                    results.append(key)
-
-        return results
+        """Returns the IDs of all sources that match the given query in the given field. If is_regex is true, query may be a pattern string or a compiled regular expression."""
+        column = self._column(field)
+
+        if is_regex:
+            # Compile the pattern once, rather than looking it up in re's cache for every source.
+            match = re.compile(query).search
+            return [key for key, value in enumerate(column) if value is not _MISSING and match(value)]
+
+        try:
+            return list(self._ensure_index(field).get(query, ()))
+        except TypeError:
+            # Unhashable values can't be indexed, so fall back to a scan.
+            return [key for key, value in enumerate(column) if value is not _MISSING and value == query]
+
+    def _invalidate(self):
+        """Drops the cached columns and indexes and marks the manifest as modified. Call this whenever the manifest changes."""
+        self._columns.clear()
+        self._indexes.clear()
+        self._dirty = True
 
     # These methods modify the manifest, and should trigger autocommit for ManifestFile.
     # If you define a new method that should trigger autocommit, mention it in ManifestFile.__getattr__.
 
     def add(self, source):
         """Adds a new source to the manifest and returns its index."""
+        if isinstance(source, dict):
+            _intern_fields(source)
         idx = len(self._manifest)
         self._manifest.append(source)
+        self._invalidate()
         return idx
 
     def replace(self, key, source):
@@ -73,7 +181,10 @@ class Manifest(object):
         if key >= len(self._manifest) or key < 0:
             raise IndexError
 
+        if isinstance(source, dict):
+            _intern_fields(source)
         self._manifest[key] = source
+        self._invalidate()
 
 
 class ManifestFile(object):
@@ -85,7 +196,7 @@ class ManifestFile(object):
     # These methods deal with context: creating and destroying a ManifestFile.
 
     def __init__(self, fname, autocommit=True, lock=True, encoding="utf_8"):
-        """Creates a new ManifestFile. Raises ValueError if the given file does not exist.
+        """Creates a new ManifestFile. Raises ValueError if the given file does not exist, or doesn't hold a valid manifest.
 
         Args:
             fname: The file where this manifest is stored.
@@ -96,20 +207,40 @@ class ManifestFile(object):
         if not os.path.isfile(fname):
             raise ValueError
         self._fname = os.path.abspath(fname)
+        self._cache_fname = self._cache_path(self._fname)
         self._autocommit = autocommit
         self._lock = lock
         self._encoding = encoding
         self._mf = None
+        self._lock_fd = None
 
-        # Locking; create the file; we don't need the fd
         if self._lock:
+            self._lock_fd = self._acquire_lock()
+
+        try:
+            self._mf = self._read()
+        except Exception:
+            self.close()
+            raise
+
+    def _acquire_lock(self):
+        lock_fname = self._fname + ".lock"
+
+        if fcntl is None:
+            # Without flock, the existence of the lock file is the lock.
             try:
-                os.close(os.open(fname + ".lock", os.O_CREAT | os.O_EXCL | os.O_RDONLY))
+                return os.open(lock_fname, os.O_CREAT | os.O_EXCL | os.O_RDONLY)
             except OSError:  # file already exists
                 raise FileLockError
 
-        with codecs.open(self._fname, "r", encoding) as mf_file:
-            self._mf = Manifest(mf_file)
+        # Lock the lock file rather than the manifest itself, since commits replace the manifest with a new file. The kernel drops the lock when the fd is closed, even if we crash, so the file can stay around.
+        fd = os.open(lock_fname, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # someone else holds the lock
+            os.close(fd)
+            raise FileLockError
+        return fd
 
     def __enter__(self):
         # We've already initialized the context in __init__
@@ -117,45 +248,147 @@ class ManifestFile(object):
 
     def close(self):
         """Closes this ManifestFile. Attempts to use a closed FileManifest will raise a ValueError. This method is idempotent: attempts to close an already-closed ManifestFile will have no effect."""
-        if self._lock:
-            os.remove(fname + ".lock")
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            if fcntl is None:
+                os.remove(self._fname + ".lock")
+            self._lock_fd = None
 
         # We signal that a ManifestFile has been closed by setting its manifest to None.
         self._mf = None
 
     def __exit__(self, e_type, unused_e, unused_e_traceback):
-        # We can close it without checking if there was an exception, since closure is idempotent, and we shouldn't leave random lock files around.
+        # We can close it without checking if there was an exception, since closure is idempotent, and we shouldn't hold on to the lock.
         self.close()
 
         if e_type:
             return False  # propagate the exception
 
+    def _read(self):
+        with open(self._fname, "rb") as mf_file:
+            st = os.fstat(mf_file.fileno())
+            # Commits replace the manifest with a new file, so the inode changes even if a rewrite keeps the size and lands in the same mtime tick.
+            stamp = (self._fname, st.st_ino, st.st_mtime_ns, st.st_size, self._encoding)
+
+            mf = self._read_cache(stamp)
+            if mf is not None:
+                return mf
+
+            if st.st_size == 0:
+                # Empty files can't be mapped; let the parser complain about them.
+                mf = Manifest.from_bytes(b"", self._encoding)
+            else:
+                # Map the file and decode straight out of the mapping, so we never hold a second copy of the raw bytes.
+                with mmap.mmap(mf_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    mf = Manifest.from_bytes(mapped, self._encoding)
+
+        self._write_cache(stamp, mf)
+        return mf
+
+    # The parsed manifest is cached as two marshalled values: a header with the cache format and a stamp identifying the manifest and the version of it that was parsed, then the sources themselves. Loading that is faster than parsing the JSON again. The cache is only a hint, so it's ignored if it's stale or unreadable, and failing to write it isn't an error.
+    # marshal isn't safe against maliciously constructed data, and source folders may be shared, so the cache isn't kept next to the manifest. It lives in the running user's cache directory, which only that user can write to, so it's trusted no more and no less than the user's other files.
+
+    @staticmethod
+    def _cache_path(fname):
+        """Returns where the parsed copy of the manifest with the given absolute path is cached."""
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_dir, "sourcewrangler", hashlib.sha256(os.fsencode(fname)).hexdigest() + ".cache")
+
+    def _read_cache(self, stamp):
+        try:
+            with open(self._cache_fname, "rb") as cache_file:
+                if marshal.load(cache_file) != (_CACHE_HEADER, stamp):
+                    return None
+                # marshal.load reads a file a few bytes at a time, so read the rest in one go and decode that.
+                sources = marshal.loads(cache_file.read())
+            # This raises ValueError if the cache doesn't hold a list of sources.
+            return Manifest._from_sources(sources)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _write_cache(self, stamp, mf):
+        tmp_fname = self._cache_fname + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self._cache_fname), mode=0o700, exist_ok=True)
+            with open(tmp_fname, "wb") as cache_file:
+                marshal.dump((_CACHE_HEADER, stamp), cache_file)
+                marshal.dump(mf._manifest, cache_file)
+            os.replace(tmp_fname, self._cache_fname)
+        except (OSError, ValueError):  # ValueError if some value can't be marshalled
+            pass
+
+    def _remove_cache(self):
+        try:
+            os.remove(self._cache_fname)
+        except OSError:
+            pass
+
     # Reversions and commits shouldn't take a file-like object anymore.
 
     def revert(self):
-        if not self._mf:
+        if self._mf is None:
             raise ValueError
 
-        with codecs.open(self._fname, "r", self._encoding) as mf_file:
-            self._mf.revert(mf_file)
+        self._mf = self._read()
 
     def commit(self):
-        if not self._mf:
+        """Writes the manifest back to disk, if it has been modified since it was last read or committed."""
+        if self._mf is None:
             raise ValueError
 
-        with codecs.open(self._fname, "w", self._encoding) as mf_file:
-            self._mf.commit(mf_file)
+        if not self._mf._dirty:
+            return
+
+        # Serialize everything up front and write it in one go. Writing to a scratch file and renaming it over the manifest means a crash can't leave a half-written manifest behind.
+        tmp_fname = self._fname + ".tmp"
+        with open(tmp_fname, "wb") as mf_file:
+            mf_file.write(self._mf.to_bytes(self._encoding))
+            mf_file.flush()
+            os.fsync(mf_file.fileno())
+        os.replace(tmp_fname, self._fname)
+        self._remove_cache()
+        self._mf._dirty = False
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that suspends autocommit inside its block. Use this to make many modifications without rewriting the manifest after each one.
+
+        If autocommit is on, the block's modifications are committed once when it exits normally. If the block raises, nothing is committed, and its modifications stay pending until the next commit. If autocommit is off, this commits nothing; call commit as usual.
+        """
+        autocommit = self._autocommit
+        self._autocommit = False
+        try:
+            yield self
+        finally:
+            self._autocommit = autocommit
+
+        if autocommit and self._mf is not None:
+            self.commit()
 
     # Other methods delegate to the Manifest, but we should autocommit and check for closure.
     def __getattr__(self, attr):
-        if not self._mf:
+        if self._mf is None:
             raise ValueError
 
+        if not callable(getattr(self._mf, attr)):
+            return getattr(self._mf, attr)
+
         # If autocommit is on, add and replace should commit.
-        if self._autocommit and (attr == "add" or attr == "replace"):
-            return lambda *args, **kwargs: getattr(self._mf, attr)(*args, **kwargs); self.commit()
+        commits = attr == "add" or attr == "replace"
+
+        # The Manifest is looked up on every call, since revert replaces it and close discards it.
+        def delegate(*args, **kwargs):
+            if self._mf is None:
+                raise ValueError
+
+            result = getattr(self._mf, attr)(*args, **kwargs)
+            if commits and self._autocommit:
+                self.commit()
+            return result
 
-        return getattr(self._mf, attr)
+        # Cache the wrapper, so later lookups find it without coming back here.
+        self.__dict__[attr] = delegate
+        return delegate
 
 
 class FileLockError(Exception):
@@ -13,6 +13,8 @@ Retrievers are bestowed with certain public fields; see the documentation for re
         output = http_retriever.run(options, tmp_folder)
 """
 
+import types
+
 
 _registry = {}
 
@@ -57,46 +59,10 @@ def register_retriever(protocol):
         if not hasattr(cls, "_run"):
             raise UnrunnableRetrieverError
 
-        # Create registries for required and optional fields.
-        cls.required = {}
-        cls.optional = {}
-
-        for method_name, method in cls.__dict__.iteritems():
-            if hasattr(method, "_required_field"):
-                # Check for duplicates.
-                if method._required_field in cls.required or method._required_field in cls.optional:
-                    raise DuplicateFieldError
-
-                cls.required[method._required_field] = method
-
-            elif hasattr(method, "_optional_field"):
-                # Check for duplicates.
-                if method._optional_field in cls.required or method._optional_field in cls.optional:
-                    raise DuplicateFieldError
-
-                cls.optional[method._optional_field] = method
+        cls.required, cls.optional = _collect_fields(cls)
 
         # Make a method to validate a retrieval object.
-        @classmethod
-        def validate(cls, retrieval):
-            # Track if we've seen every required field.
-            num_required_fields = 0
-
-            for field, value in retrieval.iteritems():
-                if field in cls.required:
-                    if not cls.required[field](value):
-                        return False
-                    num_required_fields += 1
-                elif field in cls.optional:
-                    if not cls.optional[field](value):
-                        return False
-                else:
-                    # Spurious field!
-                    return False
-            
-            # All done, did we catch 'em all?
-            return num_required_fields == len(cls.required)
-        cls.validate = validate
+        cls.validate = classmethod(_make_validate(cls.required, cls.optional))
 
         # Make a thin wrapper for run.
         def run(self, retrieval, tmp_folder):
@@ -113,6 +79,60 @@ def register_retriever(protocol):
     return decorator
 
 
+def _collect_fields(cls):
+    """Returns maps from the required and optional field names of a retriever class to their validators."""
+    required = {}
+    optional = {}
+
+    for method in vars(cls).values():
+        if hasattr(method, "_required_field"):
+            # Check for duplicates.
+            if method._required_field in required or method._required_field in optional:
+                raise DuplicateFieldError
+
+            required[method._required_field] = method
+
+        elif hasattr(method, "_optional_field"):
+            # Check for duplicates.
+            if method._optional_field in required or method._optional_field in optional:
+                raise DuplicateFieldError
+
+            optional[method._optional_field] = method
+
+    return required, optional
+
+
+def _make_validate(required, optional):
+    """Generates a validate function specialized for the given required and optional field maps.
+
+    The generated function checks each field with a single membership test and a direct call to its validator, and counts the fields it recognized to detect spurious ones, so it never has to loop over the retrieval object.
+    """
+    lines = ["def validate(cls, retrieval):"]
+    namespace = {}
+
+    for field, validator in required.items():
+        name = "_validator_%d" % len(namespace)
+        namespace[name] = validator
+        lines.append("    if %r not in retrieval or not %s(retrieval[%r]):" % (field, name, field))
+        lines.append("        return False")
+
+    # Every required field is present by now, so only optional fields need counting.
+    lines.append("    num_fields = %d" % len(required))
+    for field, validator in optional.items():
+        name = "_validator_%d" % len(namespace)
+        namespace[name] = validator
+        lines.append("    if %r in retrieval:" % field)
+        lines.append("        if not %s(retrieval[%r]):" % (name, field))
+        lines.append("            return False")
+        lines.append("        num_fields += 1")
+
+    # Anything we didn't count is a spurious field.
+    lines.append("    return num_fields == len(retrieval)")
+
+    exec("\n".join(lines), namespace)
+    return namespace["validate"]
+
+
 def required_field(name):
     """Method decorator: marks a method as the validator for a required field. The class should be decorated with register_retriever, and this decorator adds the method to required.
 
@@ -149,5 +169,11 @@ def get_retriever(protocol):
     """Gets the retriever for a given protocol, or raises InvalidProtocolError if one has not been defined."""
     try:
         return _registry[protocol]
-    except:
+    except KeyError:
         raise InvalidProtocolError
+
+
+def _freeze():
+    """Makes the registry read-only. Call this once every retriever has been registered; registering a retriever afterwards raises TypeError."""
+    global _registry
+    _registry = types.MappingProxyType(dict(_registry))
@@ -1,5 +1,13 @@
-import datetime
 import os
+import stat
+import tempfile
+import time
+
+from sourcewrangler import manifest
+
+
+# How recently a folder can have been modified for a listing of it to be cached; see ReceivingBay._listing. Some filesystems, such as FAT, only record modification times to the nearest two seconds.
+_RACY_WINDOW_NS = 2 * 10 ** 9
 
 
 class IncompleteSourceFolderError(Exception):
@@ -9,21 +17,26 @@ class IncompleteSourceFolderError(Exception):
 
 class SourceFolder(object):
     """Represents a folder that contains sources, a manifest, and other auxiliary items used by SourceWrangler."""
+    __slots__ = ("_fname", "_rbay_path", "_tmp_path", "_manifest_path", "_rbay", "_tmp", "_index", "_index_listing")
+
     @staticmethod
     def check(fname):
         """Checks that a given relative or absolute path would yield a valid SourceFolder."""
         absfname = os.path.abspath(fname)
 
-        # Is it a directory?
-        if not os.path.isdir(absfname):
+        # List it once and check the entries, rather than stat-ing each child separately. This also fails if it isn't a directory.
+        try:
+            with os.scandir(absfname) as entries:
+                found = {entry.name: entry for entry in entries}
+        except OSError:
             return False
 
         # Check for an rbay, a .tmp, and a manifest.json.
-        if not os.path.isdir(os.path.join(absfname, "rbay")):
+        if "rbay" not in found or not found["rbay"].is_dir():
             return False
-        if not os.path.isdir(os.path.join(absfname, ".tmp")):
+        if ".tmp" not in found or not found[".tmp"].is_dir():
             return False
-        if not os.path.isfile(os.path.join(absfname, "manifest.json")):
+        if "manifest.json" not in found or not found["manifest.json"].is_file():
             return False
 
         # LGTM
@@ -31,23 +44,16 @@ class SourceFolder(object):
 
     @staticmethod
     def _ensure_directory_exists(absfname):
-        if os.path.lexists(absfname):
-            if not os.path.isdir(absfname):
-                raise os.error
-            # already exists, we're done
-        else:
+        # One stat tells us both whether it exists and whether it's a directory.
+        try:
+            st = os.stat(absfname)
+        except FileNotFoundError:
             os.makedirs(absfname)
+            return
 
-    @classmethod
-    def _ensure_file_exists(cls, absfname):
-        if os.path.lexists(absfname):
-            if not os.path.isfile(absfname):
-                raise os.error
-            # already exists, we're done
-        else:
-            cls._ensure_directory_exists(os.path.join(absfname, ".."))
-            with open(absfname):
-                pass
+        if not stat.S_ISDIR(st.st_mode):
+            raise os.error
+        # already exists, we're done
 
     @classmethod
     def spawn(cls, fname):
@@ -55,23 +61,46 @@ class SourceFolder(object):
         absfname = os.path.abspath(fname)
 
         cls._ensure_directory_exists(absfname)
-        cls._ensure_directory_exists(os.path.join(absfname, "rbay"))
-        cls._ensure_directory_exists(os.path.join(absfname, ".tmp"))
-        cls._ensure_file_exists(os.path.join(absfname, "manifest.json"))
 
-        # Write an initial empty list to the manifest.
-        with open(os.path.join(absfname, "manifest.json")) as mf_json:
-            mf_json.write("[]")
+        # List the folder once to see what's already there, rather than checking each child separately.
+        with os.scandir(absfname) as entries:
+            found = {entry.name: entry for entry in entries}
+
+        for name in ("rbay", ".tmp"):
+            if name not in found:
+                os.mkdir(os.path.join(absfname, name))
+            elif not found[name].is_dir():
+                raise os.error
+
+        manifest_path = os.path.join(absfname, "manifest.json")
+        if "manifest.json" not in found:
+            # Create the manifest and write an initial empty list to it in one go.
+            with open(manifest_path, "x") as mf_json:
+                mf_json.write("[]")
+        elif not found["manifest.json"].is_file():
+            raise os.error
 
-        return cls(fname)
+        return cls(absfname)
 
     def __init__(self, fname):
-        if not self.check(fname):
+        # Resolve the path once, rather than once here and again in check.
+        self._fname = os.path.abspath(fname)
+        if not self.check(self._fname):
             raise IncompleteSourceFolderError
 
-        self._fname = os.path.abspath(fname)
-        self._rbay = ReceivingBay(os.path.join(self._fname, "rbay"))
-        self._tmp = TemporaryFolder(os.path.join(self._fname, ".tmp"))
+        # _fname is absolute and normalized, so plain concatenation is enough. It only ends with a separator if it's a root directory.
+        prefix = self._fname if self._fname.endswith(os.sep) else self._fname + os.sep
+        self._rbay_path = prefix + "rbay"
+        self._tmp_path = prefix + ".tmp"
+        self._manifest_path = prefix + "manifest.json"
+
+        # check has already made sure these exist.
+        self._rbay = ReceivingBay._trusted(self._rbay_path)
+        self._tmp = TemporaryFolder._trusted(self._tmp_path)
+
+        # Maps source keys to filenames in the receiving bay; see _ensure_index.
+        self._index = None
+        self._index_listing = None
 
     @property
     def fname(self):
@@ -80,43 +109,69 @@ class SourceFolder(object):
 
     def open(self, name, mode="r", buffering=-1):
         """Opens the file of the given name in the source folder. This does not check against e.g. someone passing in .., so it shouldn't be fed input that isn't trusted by the owner of the running user account."""
-        return open(os.path.join(_fname, name), mode, buffering)
+        return open(os.path.join(self._fname, name), mode, buffering)
 
     def available(self):
         """Returns a list of the files in the receiving bay, in arbitrary order."""
-        return os.listdir(_fname)
+        return self._rbay.available()
+
+    def _ensure_index(self):
+        """Returns a dict mapping each source key to the name of its file in the receiving bay. The dict is built from the receiving bay's cached listing, and rebuilt only when the receiving bay lists itself again."""
+        listing = self._rbay._listing()
+        if listing is not self._index_listing:
+            index = {}
+            for name in listing:
+                index.setdefault(name.split("-", 1)[0], name)
+            self._index = index
+            self._index_listing = listing
+        return self._index
 
     def get(self, key):
-        """Returns the filename of the file corresponding to the given source name. The filename is relative to the location of the source folder on disk. Raises KeyError if such a file does not exist, or if str(key) is the empty string."""
+        """Returns the filename of the file corresponding to the given source name, which is named for str(key) followed by a hyphen (e.g. 12-smith.pdf). The filename is relative to the receiving bay. Raises KeyError if such a file does not exist, or if str(key) is the empty string."""
         cached_string_key = str(key)
         if cached_string_key == "":
             raise KeyError
-        for candidate in self.available():
-            if candidate.startswith(cached_string_key):
-                return candidate
-        raise KeyError
+        return self._ensure_index()[cached_string_key]
+
+    def get_many(self, keys):
+        """Returns a dict mapping each of the given keys that has a file to that file's name, as returned by get. Keys without a file, or whose string form is empty, are left out. This lists the receiving bay at most once, however many keys are given."""
+        index = self._ensure_index()
+        found = {}
+        for key in keys:
+            cached_string_key = str(key)
+            if cached_string_key != "" and cached_string_key in index:
+                found[key] = index[cached_string_key]
+        return found
 
     def __getitem__(self, key):
         return self.get(key)
 
     def __contains__(self, key):
-        # TODO make this less nasty
-        try:
-            self.get(key)
-        except KeyError:
-            return False
-        return True
+        # Check the index directly, so misses don't cost a raised and caught KeyError.
+        cached_string_key = str(key)
+        return cached_string_key != "" and cached_string_key in self._ensure_index()
 
     def open_source(self, key, mode="r", buffering=-1):
         """Opens the file corresponding to the source with the given key (which should be an integer). Raises KeyError if such a file does not exist, or os.error if it cannot be opened. This does not check against e.g. someone passing in .., so it shouldn't be fed input that isn't trusted by the owner of the running user account."""
-        return self.open(self.get(key), mode, buffering)
+        cached_string_key = str(key)
+        if cached_string_key == "":
+            raise KeyError
+
+        # In modes that need the file to exist, try the index we already have without re-checking the receiving bay; if it's stale, the open fails and get refreshes it. Other modes would recreate a deleted file, so they always go through get.
+        if "r" in mode and self._index is not None and cached_string_key in self._index:
+            try:
+                return open(os.path.join(self._rbay_path, self._index[cached_string_key]), mode, buffering)
+            except FileNotFoundError:
+                pass
+
+        return open(os.path.join(self._rbay_path, self.get(key)), mode, buffering)
 
     def open_manifest(self):
         """Returns a new ManifestFile for the manifest of this SourceFolder.
 
         Despite its name, this method does not return a file object or file-like object. See the ManifestFile documentation for details on its interface.
         """
-        return manifest.ManifestFile(os.path.join(_fname, "manifest.json"))
+        return manifest.ManifestFile(self._manifest_path)
 
     @property
     def rbay(self):
@@ -132,11 +187,26 @@ class SourceFolder(object):
 class ReceivingBay(object):
     """Represents a receiving bay (rbay in a source folder).
 
-    A ReceivingBay is iterable, and iterates over the files it contains."""
+    A ReceivingBay is iterable, and iterates over os.DirEntry objects for the files it contains."""
+    __slots__ = ("_fname", "_available", "_available_mtime")
+
     def __init__(self, fname):
         if not os.path.isdir(fname):
             raise IncompleteSourceFolderError
-        self._fname = os.path.abspath(fname)
+        self._setup(os.path.abspath(fname))
+
+    @classmethod
+    def _trusted(cls, fname):
+        """Creates a ReceivingBay for an absolute path that the caller has already checked is a directory, skipping the check."""
+        rbay = cls.__new__(cls)
+        rbay._setup(fname)
+        return rbay
+
+    def _setup(self, fname):
+        """Initializes the attributes shared by __init__ and _trusted. fname must be absolute."""
+        self._fname = fname
+        self._available = None
+        self._available_mtime = None
 
     @property
     def fname(self):
@@ -145,22 +215,52 @@ class ReceivingBay(object):
 
     def open(self, name, mode="r", buffering=-1):
         """Opens the file of the given name in the receiving bay. This does not check against e.g. someone passing in .., so it shouldn't be fed input that isn't trusted by the owner of the running user account."""
-        return open(os.path.join(_fname, name), mode, buffering)
+        return open(os.path.join(self._fname, name), mode, buffering)
 
     def available(self):
-        """Returns a list of the files in the receiving bay, in arbitrary order."""
-        return os.listdir(_fname)
+        """Returns a list of the files in the receiving bay, in arbitrary order. The listing is cached, and only read again when the receiving bay's modification time changes."""
+        return list(self._listing())
+
+    def _listing(self):
+        """Returns the cached list of the files in the receiving bay, listing the folder again first if its modification time has changed or was too recent to rely on. Don't modify the list. Each new listing is a new list, so callers that cache something derived from it can tell whether it changed by identity."""
+        # Read the clock and stat before listing, so a change made while we list just causes another listing next time.
+        now = time.time_ns()
+        mtime = os.stat(self._fname).st_mtime_ns
+        if mtime != self._available_mtime:
+            self._available = [entry.name for entry in self.iter_entries()]
+            # A coarse modification time may not change for a file added in the same tick as the listing. Like git with racily clean files, don't trust the listing until its modification time is safely in the past; list again every time until then.
+            self._available_mtime = mtime if now - mtime > _RACY_WINDOW_NS else None
+        return self._available
+
+    def iter_entries(self):
+        """Yields an os.DirEntry for each file in the receiving bay, in arbitrary order. Entries cache the file type reported by the directory listing, so checking it usually needs no further system calls."""
+        with os.scandir(self._fname) as entries:
+            for entry in entries:
+                yield entry
 
     def __iter__(self):
-        """Iterates over the files in the receiving bay, in arbitrary order."""
-        return iter(self.available())
+        """Iterates lazily over os.DirEntry objects for the files in the receiving bay, in arbitrary order."""
+        return self.iter_entries()
 
 
 class TemporaryFolder(object):
+    __slots__ = ("_fname",)
+
     def __init__(self, fname):
         if not os.path.isdir(fname):
             raise IncompleteSourceFolderError
-        self._fname = os.path.abspath(fname)
+        self._setup(os.path.abspath(fname))
+
+    @classmethod
+    def _trusted(cls, fname):
+        """Creates a TemporaryFolder for an absolute path that the caller has already checked is a directory, skipping the check."""
+        tmp = cls.__new__(cls)
+        tmp._setup(fname)
+        return tmp
+
+    def _setup(self, fname):
+        """Initializes the attributes shared by __init__ and _trusted. fname must be absolute."""
+        self._fname = fname
 
     @property
     def fname(self):
@@ -169,33 +269,25 @@ class TemporaryFolder(object):
 
     def open(self, name, mode="r", buffering=-1):
         """Opens the file of the given name in the temporary folder. This does not check against e.g. someone passing in .., so it shouldn't be fed input that isn't trusted by the owner of the running user account."""
-        return open(os.path.join(_fname, name), mode, buffering)
+        return open(os.path.join(self._fname, name), mode, buffering)
 
     def allocate(self, suffix):
         """Creates a new file with the given suffix in the TemporaryFolder and returns it as a TemporaryFile, or raises OSError if it can't."""
-        datecode = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        datecode = time.strftime("%Y%m%d%H%M%S", time.gmtime())
 
-        opened = None
-        for attempt in xrange(1000):
-            try:
-                os.close(os.open(os.path.join(_fname, "%s-%03d%s" % (datecode, attempt, suffix)), os.O_CREAT | os.O_EXCL | os.O_RDONLY))
-                opened = attempt
-            except OSError:
-                # continue
-                pass
-
-            if opened is not None:
-                break
-
-        if opened is None:
-            raise OSError
+        # mkstemp picks an unused name and creates the file atomically.
+        fd, fname = tempfile.mkstemp(suffix=suffix, prefix=datecode + "-", dir=self._fname)
+        os.close(fd)
 
-        return new TemporaryFile(os.path.join(_fname, "%s-%03d%s" % (datecode, opened, suffix)))
+        return TemporaryFile(fname)
 
 
 class TemporaryFile(object):
+    __slots__ = ("_fname", "_cleaned")
+
     def __init__(self, fname):
         self._fname = os.path.abspath(fname)
+        self._cleaned = False
 
     @property
     def fname(self):
@@ -205,4 +297,9 @@ class TemporaryFile(object):
         return open(self._fname, mode, buffering)
 
     def cleanup(self):
+        """Deletes the file. Calling this again has no effect."""
+        if self._cleaned:
+            return
+
         os.remove(self._fname)
+        self._cleaned = True
@@ -25,3 +25,28 @@ class TestCommandRetriever(unittest.TestCase):
         self.assertEqual(TestBasicCommand.name, "test_basic")
         self.assertTrue(command.has_command("test_basic"))
         self.assertEqual(command.get_command("test_basic"), TestBasicCommand)
+
+    def test_missing(self):
+        self.assertFalse(command.has_command("test_missing"))
+        self.assertRaises(command.InvalidCommandError, command.get_command, "test_missing")
+
+    def test_freeze(self):
+        @command.register_command("test_freeze")
+        class TestFreezeCommand(object):
+            @staticmethod
+            def specify_args(argparse):
+                pass
+
+            def run(self, sf, args):
+                pass
+
+        registry = command._registry
+        command._freeze()
+        try:
+            self.assertTrue(command.has_command("test_freeze"))
+            self.assertEqual(command.get_command("test_freeze"), TestFreezeCommand)
+            self.assertIn(TestFreezeCommand, list(command.all_commands()))
+            self.assertRaises(TypeError, command.register_command("test_frozen"), TestFreezeCommand)
+            self.assertFalse(command.has_command("test_frozen"))
+        finally:
+            command._registry = registry
@@ -1,85 +1,301 @@
-import StringIO
+from io import StringIO
+import marshal
+import os
+import re
+import shutil
+import sys
+import tempfile
 import unittest
 
 from sourcewrangler import manifest
 
 class TestManifest(unittest.TestCase):
-    def _manifest_from_string(self, string):
-        buf = StringIO.StringIO(string)
-        mf = manifest.Manifest(buf)
-        return mf, buf
-
-    def test_get(self):
-        mf, buf = self._manifest_from_string("""
+    @classmethod
+    def setUpClass(cls):
+        cls._numbers = """
             [
                 {"a": 1},
                 {"a": 2, "b": 6},
                 {"a": 3, "c": 5}
             ]
-        """)
+        """
+        cls._words = """
+            [
+                {"foo": "bar", "bar": "baz"},
+                {"foo": "baz", "baz": "bar"},
+                {"bar": "quux", "quux": "foo"},
+                {"foo": "baz", "baz": "quux"}
+            ]
+        """
+        cls._more_words = """
+            [
+                {"foo": "bar", "bar": "baz"},
+                {"foo": "baz", "baz": "bar"},
+                {"bar": "quux", "quux": "foo"},
+                {"foo": "foo", "baz": "quux"}
+            ]
+        """
+
+    def _manifest_from_string(self, string):
+        buf = StringIO(string)
+        mf = manifest.Manifest(buf)
+        return mf, buf
+
+    def test_get(self):
+        mf, buf = self._manifest_from_string(self._numbers)
         obj = mf.get(1)
         self.assertEqual(obj, {"a": 2, "b": 6})
         buf.close()
 
     def test_values(self):
-        mf, buf = self._manifest_from_string("""
-            [
-                {"foo": "bar", "bar": "baz"},
-                {"foo": "baz", "baz": "bar"},
-                {"bar": "quux", "quux": "foo"}
-            ]
-        """)
+        mf, buf = self._manifest_from_string(self._words)
         vals = mf.values("foo")
         self.assertEqual(vals, set(["bar", "baz"]))
         buf.close()
 
     def test_search_exact(self):
-        mf, buf = self._manifest_from_string("""
-            [
-                {"foo": "bar", "bar": "baz"},
-                {"foo": "baz", "baz": "bar"},
-                {"bar": "quux", "quux": "foo"},
-                {"foo": "baz", "baz": "quux"}
-            ]
-        """)
+        mf, buf = self._manifest_from_string(self._words)
         results = mf.search("foo", "baz", False)
         self.assertEqual(results, [1, 3])
         buf.close()
 
     def test_search_regex(self):
+        mf, buf = self._manifest_from_string(self._more_words)
+        results = mf.search("foo", "^ba.", True)
+        self.assertEqual(results, [0, 1])
+        buf.close()
+
+    def test_add(self):
+        mf, buf = self._manifest_from_string(self._numbers)
+        idx = mf.add({"a": 7})
+        self.assertEqual(idx, 3)
+        self.assertEqual(mf.get(idx), {"a": 7})
+        buf.close()
+
+    def test_replace(self):
+        mf, buf = self._manifest_from_string(self._numbers)
+        mf.replace(2, {"a": 7})
+        self.assertEqual(mf.get(2), {"a": 7})
+        buf.close()
+
+    def test_from_bytes(self):
+        mf = manifest.Manifest.from_bytes("""
+            [
+                {"a": "café"},
+                {"a": 2, "b": 6}
+            ]
+        """.encode("utf_8"))
+        self.assertEqual(len(mf), 2)
+        self.assertEqual(mf.get(0), {"a": "café"})
+
+    def test_search_after_modification(self):
         mf, buf = self._manifest_from_string("""
             [
-                {"foo": "bar", "bar": "baz"},
-                {"foo": "baz", "baz": "bar"},
-                {"bar": "quux", "quux": "foo"},
-                {"foo": "foo", "baz": "quux"}
+                {"foo": "bar"},
+                {"foo": "baz"}
             ]
         """)
-        results = mf.search("foo", "^ba.", True)
-        self.assertEqual(results, [0, 1])
+        self.assertEqual(mf.search("foo", "baz", False), [1])
+        mf.add({"foo": "baz"})
+        mf.replace(0, {"foo": "quux"})
+        self.assertEqual(mf.search("foo", "baz", False), [1, 2])
+        self.assertEqual(mf.values("foo"), set(["baz", "quux"]))
         buf.close()
 
-    def test_add(self):
+    def test_search_unhashable(self):
         mf, buf = self._manifest_from_string("""
             [
-                {"a": 1},
-                {"a": 2, "b": 6},
-                {"a": 3, "c": 5}
+                {"foo": ["bar"]},
+                {"foo": "bar"}
             ]
         """)
-        idx = mf.add({"a": 7})
-        self.assertEqual(idx, 3)
-        self.assertEqual(mf.get(idx), {"a": 7})
+        self.assertEqual(mf.search("foo", ["bar"], False), [0])
         buf.close()
 
-    def test_replace(self):
+    def test_search_compiled_regex(self):
         mf, buf = self._manifest_from_string("""
             [
-                {"a": 1},
-                {"a": 2, "b": 6},
-                {"a": 3, "c": 5}
+                {"foo": "bar"},
+                {"foo": "BAZ"}
             ]
         """)
-        mf.replace(2, {"a": 7})
-        self.assertEqual(mf.get(2), {"a": 7})
+        results = mf.search("foo", re.compile("^ba", re.IGNORECASE), True)
+        self.assertEqual(results, [0, 1])
         buf.close()
+
+    def test_not_sources(self):
+        for text in ('{"a": 1}', "[1]", '[{"a": 1}, "b"]', "1"):
+            self.assertRaises(ValueError, manifest.Manifest.from_bytes, text.encode("utf_8"))
+            self.assertRaises(ValueError, manifest.Manifest, StringIO(text))
+
+    def test_intern(self):
+        mf = manifest.Manifest.from_bytes('[{"author": "Smith", "title": "Smith"}]'.encode("utf_8"))
+        self.assertIs(mf.get(0)["author"], sys.intern("Smith"))
+
+        # Build the strings at runtime, so they aren't interned already as constants.
+        idx = mf.add({"author": "".join(["Jo", "nes"])})
+        self.assertIs(mf.get(idx)["author"], sys.intern("Jones"))
+        mf.replace(0, {"category": "".join(["bo", "ok"])})
+        self.assertIs(mf.get(0)["category"], sys.intern("book"))
+
+
+class TestManifestFile(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._fname = os.path.join(self._dir, "manifest.json")
+        with open(self._fname, "w") as mf_file:
+            mf_file.write('[{"a": 1}]')
+
+        # Keep parsed manifests out of the real user's cache directory.
+        self._cache_dir = tempfile.mkdtemp()
+        self._old_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = self._cache_dir
+
+    def tearDown(self):
+        if self._old_cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self._old_cache_home
+        shutil.rmtree(self._cache_dir)
+        shutil.rmtree(self._dir)
+
+    def _cache_fname(self):
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        mf.close()
+        return mf._cache_fname
+
+    def _rewrite_cache(self, sources, header=None):
+        """Replaces the sources in the cache, keeping its stamp, and optionally its header."""
+        cache_fname = self._cache_fname()
+        with open(cache_fname, "rb") as cache_file:
+            old_header, stamp = marshal.load(cache_file)
+        with open(cache_fname, "wb") as cache_file:
+            marshal.dump((header or old_header, stamp), cache_file)
+            marshal.dump(sources, cache_file)
+
+    def test_autocommit(self):
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        idx = mf.add({"a": 2})
+        self.assertEqual(idx, 1)
+        mf.close()
+
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(1), {"a": 2})
+        mf.close()
+
+    def test_batch(self):
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        with mf.batch():
+            mf.add({"a": 2})
+            mf.add({"a": 3})
+            with open(self._fname) as mf_file:
+                self.assertEqual(mf_file.read(), '[{"a": 1}]')
+        mf.close()
+
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(2), {"a": 3})
+        mf.close()
+
+    def test_batch_raises(self):
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        with self.assertRaises(RuntimeError):
+            with mf.batch():
+                mf.add({"a": 2})
+                raise RuntimeError
+        with open(self._fname) as mf_file:
+            self.assertEqual(mf_file.read(), '[{"a": 1}]')
+        mf.close()
+
+    def test_batch_no_autocommit(self):
+        mf = manifest.ManifestFile(self._fname, autocommit=False, lock=False)
+        with mf.batch():
+            mf.add({"a": 2})
+        with open(self._fname) as mf_file:
+            self.assertEqual(mf_file.read(), '[{"a": 1}]')
+
+        mf.commit()
+        mf.close()
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(1), {"a": 2})
+        mf.close()
+
+    def test_closed(self):
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        mf.get(0)
+        mf.close()
+        self.assertRaises(ValueError, mf.get, 0)
+
+    def test_lock(self):
+        mf = manifest.ManifestFile(self._fname)
+        self.assertRaises(manifest.FileLockError, manifest.ManifestFile, self._fname)
+        mf.close()
+
+        mf = manifest.ManifestFile(self._fname)
+        mf.close()
+
+    def test_cache_location(self):
+        cache_fname = self._cache_fname()
+        self.assertTrue(os.path.isfile(cache_fname))
+        self.assertTrue(cache_fname.startswith(self._cache_dir + os.sep))
+        self.assertEqual(os.listdir(self._dir), ["manifest.json"])
+
+    def test_cache_hit(self):
+        self._rewrite_cache([{"a": "cached"}])
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(0), {"a": "cached"})
+        mf.close()
+
+    def test_cache_stale(self):
+        self._cache_fname()
+
+        # Replace the manifest with one of the same size and modification time, the way a commit would.
+        st = os.stat(self._fname)
+        with open(self._fname + ".new", "w") as mf_file:
+            mf_file.write('[{"a": 2}]')
+        os.replace(self._fname + ".new", self._fname)
+        os.utime(self._fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(os.path.getsize(self._fname), st.st_size)
+
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(0), {"a": 2})
+        mf.close()
+
+    def test_cache_header_mismatch(self):
+        self._rewrite_cache([{"a": "cached"}], ("sourcewrangler-manifest-cache", 0))
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(0), {"a": 1})
+        mf.close()
+
+    def test_cache_corrupt(self):
+        cache_fname = self._cache_fname()
+        with open(cache_fname, "rb") as cache_file:
+            contents = cache_file.read()
+
+        for bad_contents in (contents[:len(contents) // 2], b"\x00garbage", b""):
+            with open(cache_fname, "wb") as cache_file:
+                cache_file.write(bad_contents)
+            mf = manifest.ManifestFile(self._fname, lock=False)
+            self.assertEqual(mf.get(0), {"a": 1})
+            mf.close()
+
+    def test_cache_removed_on_commit(self):
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertTrue(os.path.isfile(mf._cache_fname))
+        mf.add({"a": 2})
+        self.assertFalse(os.path.exists(mf._cache_fname))
+        mf.close()
+
+        mf = manifest.ManifestFile(self._fname, lock=False)
+        self.assertEqual(mf.get(1), {"a": 2})
+        mf.close()
+
+    def test_not_sources(self):
+        with open(self._fname, "w") as mf_file:
+            mf_file.write('{"a": 1}')
+        self.assertRaises(ValueError, manifest.ManifestFile, self._fname)
+
+        # The failed open mustn't leave the manifest locked.
+        with open(self._fname, "w") as mf_file:
+            mf_file.write('[{"a": 1}]')
+        mf = manifest.ManifestFile(self._fname)
+        mf.close()
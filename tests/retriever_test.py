@@ -102,3 +102,56 @@ class TestRegisterRetriever(unittest.TestCase):
             "may_supply_int": 47,
             "spurious_field": "haha"
         }))
+
+    def test_required_and_optional(self):
+        @retriever.register_retriever("test_required_and_optional")
+        class TestRequiredAndOptionalRetriever(object):
+            def _run(self, retrieval, tmp_folder):
+                return "pretend this is a temp file", "text/plain"
+
+            @retriever.required_field("must_be_int")
+            def validate_must_be_int(value):
+                return type(value) == int
+
+            @retriever.optional_field("may_supply_str")
+            def validate_may_supply_str(value):
+                return type(value) == str
+
+        self.assertFalse(TestRequiredAndOptionalRetriever.validate({
+            "may_supply_str": "but where's the int?"
+        }))
+        self.assertTrue(TestRequiredAndOptionalRetriever.validate({
+            "must_be_int": 42
+        }))
+        self.assertTrue(TestRequiredAndOptionalRetriever.validate({
+            "must_be_int": 42,
+            "may_supply_str": "hello"
+        }))
+        self.assertFalse(TestRequiredAndOptionalRetriever.validate({
+            "must_be_int": 42,
+            "may_supply_str": 47
+        }))
+        self.assertFalse(TestRequiredAndOptionalRetriever.validate({
+            "must_be_int": 42,
+            "spurious_field": "hoho"
+        }))
+
+    def test_missing(self):
+        self.assertFalse(retriever.has_retriever("test_missing"))
+        self.assertRaises(retriever.InvalidProtocolError, retriever.get_retriever, "test_missing")
+
+    def test_freeze(self):
+        @retriever.register_retriever("test_freeze")
+        class TestFreezeRetriever(object):
+            def _run(self, retrieval, tmp_folder):
+                pass
+
+        registry = retriever._registry
+        retriever._freeze()
+        try:
+            self.assertTrue(retriever.has_retriever("test_freeze"))
+            self.assertEqual(retriever.get_retriever("test_freeze"), TestFreezeRetriever)
+            self.assertRaises(TypeError, retriever.register_retriever("test_frozen"), TestFreezeRetriever)
+            self.assertFalse(retriever.has_retriever("test_frozen"))
+        finally:
+            retriever._registry = registry
@@ -0,0 +1,226 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sourcewrangler import sourcefolder
+
+class TestSourceFolder(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._rbay = os.path.join(self._dir, "rbay")
+        os.mkdir(self._rbay)
+        os.mkdir(os.path.join(self._dir, ".tmp"))
+        with open(os.path.join(self._dir, "manifest.json"), "w") as mf_file:
+            mf_file.write("[]")
+        self._sf = sourcefolder.SourceFolder(self._dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _add_source(self, name, contents=""):
+        with open(os.path.join(self._rbay, name), "w") as source_file:
+            source_file.write(contents)
+
+    def _remove_source(self, name):
+        os.remove(os.path.join(self._rbay, name))
+
+    def test_check(self):
+        self.assertTrue(sourcefolder.SourceFolder.check(self._dir))
+        self.assertFalse(sourcefolder.SourceFolder.check(os.path.join(self._dir, "missing")))
+        self.assertFalse(sourcefolder.SourceFolder.check(os.path.join(self._dir, "manifest.json")))
+
+        os.rmdir(os.path.join(self._dir, ".tmp"))
+        self.assertFalse(sourcefolder.SourceFolder.check(self._dir))
+        self.assertRaises(sourcefolder.IncompleteSourceFolderError, sourcefolder.SourceFolder, self._dir)
+
+        with open(os.path.join(self._dir, ".tmp"), "w"):
+            pass
+        self.assertFalse(sourcefolder.SourceFolder.check(self._dir))
+
+    def test_available(self):
+        self.assertEqual(self._sf.available(), [])
+        self._add_source("1-smith.pdf")
+        self._add_source("2-jones.html")
+        self.assertEqual(sorted(self._sf.available()), ["1-smith.pdf", "2-jones.html"])
+        self.assertEqual(sorted(self._sf.rbay.available()), ["1-smith.pdf", "2-jones.html"])
+
+    def test_get(self):
+        self.assertRaises(KeyError, self._sf.get, 12)
+
+        self._add_source("12-smith.pdf")
+        self.assertEqual(self._sf.get(12), "12-smith.pdf")
+        self.assertEqual(self._sf[12], "12-smith.pdf")
+        self.assertRaises(KeyError, self._sf.get, 1)
+
+        self._remove_source("12-smith.pdf")
+        self.assertRaises(KeyError, self._sf.get, 12)
+
+    def test_get_empty_key(self):
+        self._add_source("-foo")
+        self.assertRaises(KeyError, self._sf.get, "")
+
+    def test_contains(self):
+        self.assertNotIn(12, self._sf)
+
+        self._add_source("12-smith.pdf")
+        self.assertIn(12, self._sf)
+        self.assertNotIn(1, self._sf)
+
+        self._remove_source("12-smith.pdf")
+        self.assertNotIn(12, self._sf)
+
+        self._add_source("-foo")
+        self.assertNotIn("", self._sf)
+
+    def test_spawn(self):
+        fname = os.path.join(self._dir, "new")
+        sf = sourcefolder.SourceFolder.spawn(fname)
+        self.assertEqual(sf.fname, os.path.abspath(fname))
+        self.assertTrue(sourcefolder.SourceFolder.check(fname))
+        with open(os.path.join(fname, "manifest.json")) as mf_file:
+            self.assertEqual(mf_file.read(), "[]")
+
+    def test_spawn_existing(self):
+        with open(os.path.join(self._dir, "manifest.json"), "w") as mf_file:
+            mf_file.write('[{"a": 1}]')
+        self._add_source("1-smith.pdf")
+
+        sf = sourcefolder.SourceFolder.spawn(self._dir)
+        self.assertEqual(sf.get(1), "1-smith.pdf")
+        with open(os.path.join(self._dir, "manifest.json")) as mf_file:
+            self.assertEqual(mf_file.read(), '[{"a": 1}]')
+
+    def test_spawn_invalid(self):
+        os.rmdir(os.path.join(self._dir, ".tmp"))
+        with open(os.path.join(self._dir, ".tmp"), "w"):
+            pass
+        self.assertRaises(os.error, sourcefolder.SourceFolder.spawn, self._dir)
+
+    def test_iter(self):
+        self._add_source("1-smith.pdf")
+        os.mkdir(os.path.join(self._rbay, "2-jones"))
+
+        found = {entry.name: entry.is_file() for entry in self._sf.rbay}
+        self.assertEqual(found, {"1-smith.pdf": True, "2-jones": False})
+
+        # Iteration hands out DirEntry objects as it goes, rather than a prebuilt list of names.
+        entries = iter(self._sf.rbay)
+        self.assertIsInstance(next(entries), os.DirEntry)
+        entries.close()
+
+    def test_get_many(self):
+        self._add_source("1-smith.pdf")
+        self._add_source("2-jones.html")
+        self._add_source("-foo")
+        self.assertEqual(self._sf.get_many([1, 2, 3, ""]), {1: "1-smith.pdf", 2: "2-jones.html"})
+
+        self._remove_source("1-smith.pdf")
+        self._add_source("3-brown.txt")
+        self.assertEqual(self._sf.get_many([1, 2, 3]), {2: "2-jones.html", 3: "3-brown.txt"})
+
+    def test_open_source(self):
+        self._add_source("12-smith.txt", "hello")
+        with self._sf.open_source(12) as source_file:
+            self.assertEqual(source_file.read(), "hello")
+
+        self._remove_source("12-smith.txt")
+        self.assertRaises(KeyError, self._sf.open_source, 12)
+
+    def test_trusted(self):
+        self.assertEqual(self._sf.rbay.fname, self._rbay)
+        self.assertEqual(self._sf.tmp.fname, os.path.join(self._dir, ".tmp"))
+
+        rbay = sourcefolder.ReceivingBay._trusted(self._rbay)
+        self._add_source("1-smith.pdf")
+        self.assertEqual(rbay.available(), ["1-smith.pdf"])
+
+        tmp = sourcefolder.TemporaryFolder._trusted(os.path.join(self._dir, ".tmp"))
+        tmp_file = tmp.allocate(".txt")
+        self.assertEqual(os.path.dirname(tmp_file.fname), tmp.fname)
+        tmp_file.cleanup()
+
+    def test_open_source_stale(self):
+        self._add_source("12-smith.txt")
+        self._sf.open_source(12).close()
+        self._remove_source("12-smith.txt")
+
+        # Modes that create files mustn't bring back a source that the index still remembers.
+        self.assertRaises(KeyError, self._sf.open_source, 12, "w")
+        self.assertEqual(os.listdir(self._rbay), [])
+
+    def test_open_source_empty_key(self):
+        self._add_source("-foo")
+        self.assertRaises(KeyError, self._sf.get, 1)  # builds the index
+        self.assertRaises(KeyError, self._sf.open_source, "")
+
+    def test_available_cached(self):
+        # Pretend the receiving bay was last modified a while ago.
+        mtime = os.stat(self._rbay).st_mtime_ns - 10 ** 10
+        os.utime(self._rbay, ns=(mtime, mtime))
+        self.assertEqual(self._sf.rbay.available(), [])
+
+        # A change that leaves the modification time as it was goes unnoticed, by the index too...
+        self._add_source("1-smith.pdf")
+        os.utime(self._rbay, ns=(mtime, mtime))
+        self.assertEqual(self._sf.rbay.available(), [])
+        self.assertNotIn(1, self._sf)
+
+        # ...until the modification time changes.
+        os.utime(self._rbay, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+        self.assertEqual(self._sf.rbay.available(), ["1-smith.pdf"])
+        self.assertIn(1, self._sf)
+
+    def test_available_copy(self):
+        self._add_source("1-smith.pdf")
+        names = self._sf.rbay.available()
+        names.append("2-jones.html")
+        self.assertEqual(self._sf.rbay.available(), ["1-smith.pdf"])
+        self.assertEqual(self._sf.available(), ["1-smith.pdf"])
+
+    def test_get_same_tick(self):
+        self.assertNotIn(5, self._sf)  # builds the index
+        mtime = os.stat(self._rbay).st_mtime_ns
+
+        # On a filesystem with coarse timestamps, adding a file in the same tick leaves the modification time as it was.
+        self._add_source("5-x.pdf")
+        os.utime(self._rbay, ns=(mtime, mtime))
+        self.assertIn(5, self._sf)
+        self.assertEqual(self._sf.get(5), "5-x.pdf")
+        self.assertEqual(self._sf.available(), ["5-x.pdf"])
+
+
+
+class TestTemporaryFolder(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._tmp = sourcefolder.TemporaryFolder(self._dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_allocate(self):
+        tmp_file = self._tmp.allocate(".txt")
+        self.assertTrue(tmp_file.fname.endswith(".txt"))
+        self.assertEqual(os.path.dirname(tmp_file.fname), os.path.abspath(self._dir))
+        self.assertEqual(os.path.getsize(tmp_file.fname), 0)
+
+        with tmp_file.open("w") as f:
+            f.write("hello")
+        tmp_file.cleanup()
+        self.assertFalse(os.path.exists(tmp_file.fname))
+        self.assertEqual(os.listdir(self._dir), [])
+
+    def test_missing_folder(self):
+        self.assertRaises(sourcefolder.IncompleteSourceFolderError, sourcefolder.TemporaryFolder, os.path.join(self._dir, "missing"))
+
+    def test_cleanup_twice(self):
+        first = self._tmp.allocate(".txt")
+        first.cleanup()
+        second = self._tmp.allocate(".txt")
+
+        # A repeated cleanup has no effect, so it can't touch anything allocated since.
+        first.cleanup()
+        self.assertTrue(os.path.isfile(second.fname))
+        second.cleanup()
+        self.assertEqual(os.listdir(self._dir), [])